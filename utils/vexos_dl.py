@@ -1,13 +1,44 @@
 # IMPORTS #
+import concurrent.futures
+import functools
+import hashlib
 import json
 import os
+import re
 import shutil
+import subprocess
 import sys
+import tempfile
+import zipfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# OPTIONAL IMPORTS #
+try:
+    import libarchive
+except ImportError:
+    libarchive = None
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # CONSTANTS #
 vexos_base_url = "https://content.vexrobotics.com/vexos/public/V5/"
 vexos_catalog_url = vexos_base_url + "catalog.txt"
+vexos_catalog_cache = ".vexos_catalog.json"
+vexos_version_regex = re.compile(r"VEXOS_V5_([0-9]+)_([0-9]+)_([0-9]+)_([0-9]+)")
+download_chunk_size = 1024 * 1024
+extract_chunk_size = 1024 * 1024
+extract_large_chunk_size = 4 * 1024 * 1024
+extract_large_file_size = 8 * 1024 * 1024
+
+# HTTP SESSION #
+# Shared across the catalog and firmware requests so the connection to the VEX server is reused.
+session = requests.Session()
+session.headers["Accept-Encoding"] = "gzip"
+session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.3)))
 
 # DOWNLOADER FUNCTIONS #
 def download_vexos(vexos_version):
@@ -17,22 +48,171 @@ def download_vexos(vexos_version):
     Args:
         vexos_version (str): The version of VEXos to download.
         path (str): The path to download the file to.
+
+    Returns:
+        str: The SHA-256 hash of the downloaded package.
     """
     # Get Download URL
     vexos_download_url = vexos_base_url + vexos_version + ".vexos"
 
     # Download File
     try:
-        vexos_package = requests.get(vexos_download_url)
-    except requests.exceptions.ConnectionError:
-        raise "ERROR: Failed to download ${vexos_version}. Please check your internet connection."
+        vexos_package = session.get(vexos_download_url, stream=True, timeout=30)
+        vexos_package.raise_for_status()
+    except requests.exceptions.HTTPError as error:
+        raise IOError("ERROR: Failed to download " + vexos_version + " (HTTP " + str(error.response.status_code) + "). Please check that the version exists.")
+    except requests.exceptions.RequestException:
+        raise IOError("ERROR: Failed to download " + vexos_version + ". Please check your internet connection.")
+
+    # Save File (streamed to disk in chunks and hashed on the way, so the package is never re-read)
+    # Written under a temporary name first so an interrupted download never looks like a downloaded package
+    package_hash = hashlib.sha256()
+    downloaded = False
+    with vexos_package:
+        try:
+            with open("vexos.vexos.part", "wb") as vexos_file:
+                for chunk in vexos_package.iter_content(download_chunk_size):
+                    package_hash.update(chunk)
+                    vexos_file.write(chunk)
+            os.replace("vexos.vexos.part", "vexos.vexos")
+            downloaded = True
+        except requests.exceptions.RequestException:
+            raise IOError("ERROR: Failed to download " + vexos_version + ". Please check your internet connection.")
+        except IOError:
+            raise IOError("ERROR: Failed to save " + vexos_version + " to file. Please check your permissions.")
+        finally:
+            # Delete Partial Download
+            if not downloaded:
+                try:
+                    os.remove("vexos.vexos.part")
+                except IOError:
+                    pass
+
+    # Return SHA-256 Hash
+    return package_hash.hexdigest()
+
+def extract_member(vexos_archive, member, path, created_folders):
+    """
+    Extracts a single file from the VEXos package by streaming it to disk.
+
+    Args:
+        vexos_archive (zipfile.ZipFile): The opened VEXos package.
+        member (zipfile.ZipInfo): The archive entry to extract.
+        path (str): The path to extract the file to.
+        created_folders (set): Folders already created (skips repeated makedirs calls).
+    """
+    # Get Destination Path (ZipFile.extract-style sanitizing so entries can't escape the target folder)
+    member_parts = [part for part in member.filename.split("/") if part not in ("", ".", "..")]
+
+    # Strip the package's top-level folder so files land directly in the target folder
+    if len(member_parts) > 1 or member.is_dir():
+        member_parts = member_parts[1:]
+    member_path = os.path.join(path, *member_parts)
+
+    # Create Folders
+    member_folder = member_path if member.is_dir() else os.path.dirname(member_path)
+    if member_folder not in created_folders:
+        os.makedirs(member_folder, exist_ok=True)
+        created_folders.add(member_folder)
+    if member.is_dir():
+        return
+
+    # Copy File (larger files get a larger buffer)
+    chunk_size = extract_large_chunk_size if member.file_size > extract_large_file_size else extract_chunk_size
+    with vexos_archive.open(member) as member_file, open(member_path, "wb") as output_file:
+        shutil.copyfileobj(member_file, output_file, chunk_size)
+
+def extract_members(members, path):
+    """
+    Extracts a group of files from the VEXos package (ran on a worker thread).
+
+    Args:
+        members (list): The archive entries (zipfile.ZipInfo) to extract.
+        path (str): The path to extract the files to.
+    """
+    # Every worker opens its own handle since ZipFile isn't safe to share between threads
+    created_folders = set()
+    with zipfile.ZipFile("vexos.vexos") as vexos_archive:
+        for member in members:
+            extract_member(vexos_archive, member, path, created_folders)
+
+def extract_with_zipfile(path):
+    """
+    Extracts the VEXos package using Python's zipfile module.
+
+    Args:
+        path (str): The path to extract the file to.
+    """
+    # Get Archive Members
+    with zipfile.ZipFile("vexos.vexos") as vexos_archive:
+        members = vexos_archive.infolist()
+    if len(members) == 0:
+        raise IOError("ERROR: The VexOS package is empty.")
+
+    # Split members between workers (zlib and file writes release the GIL)
+    worker_count = max(1, min(os.cpu_count() or 1, len(members)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+        workers = [executor.submit(extract_members, members[i::worker_count], path) for i in range(worker_count)]
+        for worker in workers:
+            worker.result()
+
+def extract_with_libarchive(path):
+    """
+    Extracts the VEXos package using libarchive (optional, faster on packages with many small files).
 
-    # Save File
+    Args:
+        path (str): The path to extract the file to.
+    """
+    # libarchive extracts into the working directory
+    vexos_package_path = os.path.abspath("vexos.vexos")
+    os.makedirs(path, exist_ok=True)
+    working_directory = os.getcwd()
+    os.chdir(path)
     try:
-        with open("vexos.vexos", "wb") as vexos_file:
-            vexos_file.write(vexos_package.content)
-    except IOError:
-        raise "ERROR: Failed to save ${vexos_version} to file. Please check your permissions."
+        libarchive.extract_file(vexos_package_path, libarchive.extract.EXTRACT_SECURE_NODOTDOT | libarchive.extract.EXTRACT_SECURE_SYMLINKS)
+    except libarchive.ArchiveError as error:
+        raise IOError(error)
+    finally:
+        os.chdir(working_directory)
+    move_subfolder_contents(path)
+
+def move_subfolder_contents(path):
+    """
+    Moves the contents of the package's top-level folder up into the target folder.
+
+    Args:
+        path (str): The path the package was extracted to.
+    """
+    # Move contents of extracted folder to vexos folder
+    with os.scandir(path) as entries:
+        vexos_subfolder = next(entries, None)
+    if vexos_subfolder == None:
+        raise IOError("ERROR: The VexOS package is empty.")
+    with os.scandir(vexos_subfolder.path) as entries:
+        for entry in entries:
+            shutil.move(entry.path, path)
+    shutil.rmtree(vexos_subfolder.path)
+
+def extract_with_command(path):
+    """
+    Extracts the VEXos package using the system's unzip or bsdtar command.
+
+    Args:
+        path (str): The path to extract the file to.
+    """
+    # Get Command
+    if shutil.which("unzip") != None:
+        command = ["unzip", "-q", "-o", "vexos.vexos", "-d", path]
+    else:
+        os.makedirs(path, exist_ok=True)
+        command = ["bsdtar", "-xf", "vexos.vexos", "-C", path]
+
+    # Run Command
+    try:
+        subprocess.run(command, check=True)
+    except (subprocess.CalledProcessError, OSError) as error:
+        raise IOError(error)
+    move_subfolder_contents(path)
 
 def extract_vexos():
     """
@@ -41,61 +221,113 @@ def extract_vexos():
     Args:
         path (str): The path to extract the file to.
     """
-    # Delete Old Files
+    # Extract into a new folder first so the old installation survives a failed extraction
     try:
-        shutil.rmtree("vexos")
+        extract_path = tempfile.mkdtemp(prefix="vexos.new.", dir=".")
+        os.chmod(extract_path, 0o755)
     except IOError:
-        pass
+        raise IOError("ERROR: Failed to extract VexOS. Please check your permissions.")
 
-    # Extract File
+    # Extract File (system unzip/bsdtar if available, then libarchive, then zipfile)
+    extracted = False
     try:
-        shutil.unpack_archive("vexos.vexos", "vexos", "zip")
-    except IOError:
-        raise "ERROR: Failed to extract VexOS. Please check your permissions."
-
-    # Move contents of extracted folder to vexos folder
-    vexos_subfolder = os.listdir("vexos")[0]
-    vexos_subfolder_path = os.path.join("vexos", vexos_subfolder)
-    for file in os.listdir(vexos_subfolder_path):
-        shutil.move(os.path.join(vexos_subfolder_path, file), "vexos")
-    shutil.rmtree(vexos_subfolder_path)
+        if shutil.which("unzip") != None or shutil.which("bsdtar") != None:
+            extract_with_command(extract_path)
+        elif libarchive != None:
+            extract_with_libarchive(extract_path)
+        else:
+            extract_with_zipfile(extract_path)
+        extracted = True
+    except (IOError, zipfile.BadZipFile):
+        raise IOError("ERROR: Failed to extract VexOS. The package may be corrupt, or please check your permissions.")
+    finally:
+        # Never leave a partial extraction behind
+        if not extracted:
+            shutil.rmtree(extract_path, ignore_errors=True)
+
+    # Swap in the new installation (renames instead of deleting the old files, see remove_old_installation)
+    restore_old_installation()
+    shutil.rmtree("vexos.old", ignore_errors=True)
+    if os.path.exists("vexos"):
+        os.replace("vexos", "vexos.old")
+    os.replace(extract_path, "vexos")
+
+def restore_old_installation():
+    """
+    Restores the previous installation if an earlier run stopped between swapping it out and swapping the new one in.
+    """
+    # Restore Old Files
+    if not os.path.exists("vexos") and os.path.exists("vexos.old"):
+        os.replace("vexos.old", "vexos")
 
-    
+def remove_old_installation():
+    """
+    Deletes the previous installation once the new one has been swapped in.
+    """
+    # Delete Old Files
+    shutil.rmtree("vexos.old", ignore_errors=True)
 
 def get_latest_version():
     """
     Downloads the VEXos catalog file from the VEX website.
     """
+    # Load Cached Catalog
+    try:
+        with open(vexos_catalog_cache, "r") as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        cache = {}
+
+    # Only ask for the catalog if it changed since it was cached
+    headers = {}
+    if cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+    if cache.get("last_modified"):
+        headers["If-Modified-Since"] = cache["last_modified"]
+
     # Download File
     try:
-        catalog = requests.get(vexos_catalog_url)
-    except requests.exceptions.ConnectionError:
-        raise "ERROR: Failed to download catalog. Please check your internet connection."
+        catalog = session.get(vexos_catalog_url, headers=headers, timeout=30)
+    except requests.exceptions.RequestException:
+        raise IOError("ERROR: Failed to download catalog. Please check your internet connection.")
+
+    # Reuse Cached Catalog If Unchanged
+    if catalog.status_code == 304 and "text" in cache:
+        return cache["text"].strip()
 
     # Check if format is valid
     if not catalog.text.startswith("VEXOS_V5_"):
-        raise "ERROR: Failed to parse catalog. Please check your internet connection."
-    else:
-        return catalog.text
+        raise IOError("ERROR: Failed to parse catalog. Please check your internet connection.")
+
+    # Save Catalog To Cache
+    try:
+        with open(vexos_catalog_cache, "w") as cache_file:
+            json.dump({
+                "etag": catalog.headers.get("ETag"),
+                "last_modified": catalog.headers.get("Last-Modified"),
+                "text": catalog.text,
+            }, cache_file)
+    except IOError:
+        pass
+
+    # Return Version (without the catalog's trailing newline, which would end up in the download URL)
+    return catalog.text.strip()
 
 # VERSIONING FUNCTIONS #
+@functools.lru_cache(maxsize=32)
 def vexos_to_semver(version):
     """
     Converts a VEXos version to a SemVer version.
     """
-    # Split Version
-    version_split = version.split("_")
+    # Parse Version
+    version_match = vexos_version_regex.fullmatch(version)
 
     # Check if format is valid
-    if len(version_split) != 6:
-        raise "ERROR: Failed to parse VEXos version. Please try again later."
-    if version_split[0] != "VEXOS":
-        raise "ERROR: Failed to parse VEXos version. Please try again later."
-    if version_split[1] != "V5":
-        raise "ERROR: Failed to parse VEXos version. Please try again later."
-    
+    if version_match == None:
+        raise ValueError("ERROR: Failed to parse VEXos version. Please try again later.")
+
     # Convert to SemVer
-    return version_split[2] + "." + version_split[3] + "." + version_split[4] + "." + version_split[5]
+    return ".".join(version_match.groups())
 
 def is_outdated(current, latest):
     """
@@ -103,120 +335,122 @@ def is_outdated(current, latest):
 
     Args:
         current (str): The current VEXos version (semver - manifest).
-        latest (str): The latest VEXos version (vexos - catalog).
-    """
-    current_semver = current.split(".")
-    latest_semver = vexos_to_semver(latest).split(".")
-
-    # Check if outdated
-    if current_semver[0] > latest_semver[0]:
-        return False
-    elif current_semver[0] < latest_semver[0]:
-        return True
-
-    # Compare minor versions
-    if current_semver[1] > latest_semver[1]:
-        return False
-    elif current_semver[1] < latest_semver[1]:
-        return True
-
-    # Compare patch versions
-    if current_semver[2] > latest_semver[2]:
-        return False
-    elif current_semver[2] < latest_semver[2]:
-        return True
-
-    # Compare build versions
-    if current_semver[3] > latest_semver[3]:
-        return False
-    elif current_semver[3] < latest_semver[3]:
-        return True
-
-    # If all parts are equal, the versions are equal
-    return False
+        latest (str): The latest VEXos version (semver - see vexos_to_semver).
+    """
+    # Compare numerically, part by part (so 1.10.0.0 is newer than 1.9.0.0)
+    current_semver = tuple(map(int, current.split(".")))
+    latest_semver = tuple(map(int, latest.split(".")))
+    return current_semver < latest_semver
 
 def get_installed_version():
     """
     Gets the currently installed VEXos version.
     """
+    # Get Manifest Modification Time (a reinstall changes it, so the cached version is dropped)
+    try:
+        manifest_modified_time = os.stat("vexos/manifest.json").st_mtime_ns
+    except IOError:
+        raise IOError("ERROR: Failed to read manifest.json. Please check your permissions.")
+
+    # Return VEXos Version
+    return read_installed_version(manifest_modified_time)
+
+@functools.lru_cache(maxsize=4)
+def read_installed_version(manifest_modified_time):
+    """
+    Reads the currently installed VEXos version from manifest.json (cached per modification time).
+
+    Args:
+        manifest_modified_time (int): The modification time of manifest.json (in nanoseconds).
+    """
     # Get Installed Version
     try:
-        with open("vexos/manifest.json", "r") as manifest_file:
+        with open("vexos/manifest.json", "rb") as manifest_file:
             manifest = manifest_file.read()
     except IOError:
         raise IOError("ERROR: Failed to read manifest.json. Please check your permissions.")
 
     # Parse JSON
     try:
-        manifest = json.loads(manifest)
-    except json.JSONDecodeError:
-        raise "ERROR: Failed to parse manifest.json. Please check if the file is valid."
+        manifest = json_loads(manifest)
+    except ValueError:
+        raise IOError("ERROR: Failed to parse manifest.json. Please check if the file is valid.")
 
     # Get VEXos Version
     try:
         vexos_version = manifest["version"]
-    except KeyError:
-        raise "ERROR: Failed to parse manifest.json. Please check if the file is valid."
+    except (KeyError, TypeError):
+        raise IOError("ERROR: Failed to parse manifest.json. Please check if the file is valid.")
 
     # Return VEXos Version
     return vexos_version
 
+def get_installed_version_safe():
+    """
+    Gets the currently installed VEXos version (None if VEXos isn't installed).
+    """
+    # Get Installed Version
+    try:
+        return get_installed_version()
+    except IOError:
+        return None
+
 # Conflict Checker Functions #
 def package_already_downloaded():
     """
     Checks if the VEXos package has already been downloaded.
     """
     # Check if File Exists
-    try:
-        with open("vexos.vexos", "rb") as vexos_file:
-            return True
-    except IOError:
-        return False
+    return os.path.exists("vexos.vexos")
 
 def resolve_conflicts():
     """
-    Resolves any installation conflicts by deleting the old files.
+    Resolves any installation conflicts by deleting the old package (the old installation is replaced during extraction).
     """
     # Delete Old Files
     try:
         os.remove("vexos.vexos")
     except IOError:
         pass
-    try:
-        shutil.rmtree("vexos")
-    except IOError:
-        pass
     
 
 # INSTALLER FUNCTIONS #
-def install_vexos(force, version):
+def install_vexos(force, version, sha256=None):
     """
     Installs VEXos.
 
     Args:
         force (bool): Whether to force the installation of VEXos.
         version (str): The version of VEXos to install.
+        sha256 (str): The expected SHA-256 hash of the VEXos package (skips verification if None).
     """
-    # Get Latest Version If Not Specified
-    if version == None:
-        print("Getting Latest Version...")
-        version = get_latest_version()
-        print("Latest Version: " + vexos_to_semver(version))
-    else:
-        print("Version Specified: " + version)
-    
-    # Get Installed Version
-    try:
-        installed_version = get_installed_version()
-    except IOError:
-        installed_version = None
+    # Recover from an interrupted installation
+    restore_old_installation()
+
+    # Get Latest and Installed Versions (at the same time)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        installed_version_future = executor.submit(get_installed_version_safe)
+
+        # Get Latest Version If Not Specified
+        if version == None:
+            print("Getting Latest Version...")
+            version = executor.submit(get_latest_version).result()
+            version_semver = vexos_to_semver(version)
+            print("Latest Version: " + version_semver)
+        else:
+            print("Version Specified: " + version)
+            version_semver = vexos_to_semver(version)
+
+        # Get Installed Version
+        installed_version = installed_version_future.result()
     
     # Check if Outdated (if installed)
     if installed_version != None:
-        if not is_outdated(installed_version, version) and not force:
+        outdated = is_outdated(installed_version, version_semver)
+        if not outdated and not force:
             print("Your VexOS installation is up to date.")
             return
-        elif not is_outdated(installed_version, version) and force:
+        elif not outdated and force:
             print("Your VexOS installation is up to date, but continuing anyway.")
         else:
             print("An update is available (currently installed: " + installed_version + ").")
@@ -237,9 +471,17 @@ def install_vexos(force, version):
     
     # Download VexOS
     print("Downloading VexOS...")
-    download_vexos(version)
+    package_hash = download_vexos(version)
     print("Downloaded VexOS.")
 
+    # Verify VexOS (the catalog doesn't publish hashes, so only when one is given)
+    if sha256 != None:
+        print("Verifying VexOS...")
+        if package_hash != sha256.lower():
+            os.remove("vexos.vexos")
+            raise IOError("ERROR: The downloaded package does not match the expected SHA-256 hash. Please try again.")
+        print("Verified VexOS.")
+
     # Extract VexOS
     print("Extracting VexOS...")
     extract_vexos()
@@ -256,7 +498,10 @@ def install_vexos(force, version):
         print("OLD VERSION: " + installed_version)
     else:
         print("OLD VERSION: None")
-    print("NEW VERSION: " + vexos_to_semver(version))    
+    print("NEW VERSION: " + version_semver)
+
+    # Delete Old Installation (after the summary, since it walks every old file)
+    remove_old_installation()
 
 # MISC FUNCTIONS #
 def print_help():
@@ -265,6 +510,7 @@ def print_help():
     print("Arguments:")
     print("  -f, --force: Forces the installation of VEXos (even if there are conflicts or no available updates).")
     print("  -v, --version: Installs a specific version of VEXos (format: \"VEXOS_V5_X_X_X_X\").")
+    print("  -s, --sha256: Verifies the downloaded package against the given SHA-256 hash.")
     print("  -h, --help: Prints this help message.")
     exit(0)
 
@@ -272,17 +518,25 @@ def main():
     # Parse Arguments
     force_enabled = False
     version = None
-    for arg in sys.argv[1:]:
+    sha256 = None
+    args = iter(sys.argv[1:])
+    for arg in args:
         if arg == "-f" or arg == "--force":
             force_enabled = True
         elif arg == "-v" or arg == "--version":
-            version = sys.argv[sys.argv.index(arg) + 1]
+            version = next(args, None)
             force_enabled = True
+            if version == None:
+                print_help()
+        elif arg == "-s" or arg == "--sha256":
+            sha256 = next(args, None)
+            if sha256 == None:
+                print_help()
         elif arg == "-h" or arg == "--help":
             print_help()
     
     # Install VexOS
-    install_vexos(force_enabled, version)
+    install_vexos(force_enabled, version, sha256)
 
 if __name__ == "__main__":
     main()